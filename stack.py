@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import argparse
 import contextlib
+import datetime
+import email.utils
 import enum
 import functools
 import json
@@ -8,19 +10,20 @@ import logging
 import os
 import re
 import subprocess
+import sys
+import time
 import urllib.parse
 
-import networkx
-import requests
-
 
 PR_PATTERN = re.compile(
     r"^https://api.github.com/repos/(?P<repo>[\w\-]+/[\w\-]+)/pulls/(?P<number>\d+)$"
 )
 
-ORIGIN_PATTERN = re.compile(
-    r"^origin\tgit@github.com:(?P<repo>[\w\-]+/[\w\-]+).git \(push\)$", re.MULTILINE
-)
+ORIGIN_PATTERN = re.compile(r"github\.com[:/](?P<repo>[\w\-]+/[\w\-]+?)(?:\.git)?$")
+
+GITHUB_RETRIES = 5
+
+MERGE_BASE_CACHE_SIZE = 256
 
 
 class Actions(enum.StrEnum):
@@ -29,80 +32,255 @@ class Actions(enum.StrEnum):
     restack = "restack"
     move_onto = "move-onto"
     submit = "submit"
+    submit_stack = "submit-stack"
+    status = "status"
+    inspect = "inspect"
     forget = "forget"
 
 
+class Graph:
+    """Just enough of networkx.DiGraph to hold a stack of branches"""
+
+    def __init__(self):
+        self.graph: dict = {}
+        self.nodes: dict[str, dict] = {}
+        self.parents: dict[str, list[str]] = {}
+        self.children: dict[str, list[str]] = {}
+        self.sha_index: dict[str, str] | None = None
+
+    def add_node(self, node_id: str, **attrs):
+        if node_id not in self.nodes:
+            self.nodes[node_id] = {}
+            self.parents[node_id], self.children[node_id] = [], []
+        self.nodes[node_id].update(attrs)
+        self.sha_index = None
+
+    def remove_node(self, node_id: str):
+        for parent_id in self.parents[node_id]:
+            self.children[parent_id].remove(node_id)
+        for child_id in self.children[node_id]:
+            self.parents[child_id].remove(node_id)
+        del self.nodes[node_id], self.parents[node_id], self.children[node_id]
+        self.sha_index = None
+
+    def add_edge(self, parent_id: str, child_id: str):
+        self.add_node(parent_id)
+        self.add_node(child_id)
+        if child_id not in self.children[parent_id]:
+            self.children[parent_id].append(child_id)
+            self.parents[child_id].append(parent_id)
+
+    def remove_edge(self, parent_id: str, child_id: str):
+        self.children[parent_id].remove(child_id)
+        self.parents[child_id].remove(parent_id)
+
+    def predecessors(self, node_id: str) -> list[str]:
+        return list(self.parents[node_id])
+
+    def successors(self, node_id: str) -> list[str]:
+        return list(self.children[node_id])
+
+    def descendants(self, node_id: str) -> set[str]:
+        found, pending = set(), list(self.children[node_id])
+        while pending:
+            if (child_id := pending.pop()) not in found:
+                found.add(child_id)
+                pending.extend(self.children[child_id])
+        return found
+
+    def topological_sort(self) -> list[str]:
+        in_degree = {node_id: len(self.parents[node_id]) for node_id in self.nodes}
+        ordered = [node_id for node_id, degree in in_degree.items() if degree == 0]
+        for node_id in ordered:
+            for child_id in self.children[node_id]:
+                in_degree[child_id] -= 1
+                if in_degree[child_id] == 0:
+                    ordered.append(child_id)
+        return ordered
+
+    def generate_network_text(self):
+        # Lines laid out like networkx.generate_network_text(), with their nodes
+        roots = [node_id for node_id in self.nodes if not self.parents[node_id]]
+        for i, root_id in enumerate(roots):
+            is_last = i == len(roots) - 1
+            yield root_id, f"{'╙──' if is_last else '╟──'} {root_id}"
+            yield from self._generate_child_text(root_id, "    " if is_last else "╎   ")
+
+    def _generate_child_text(self, node_id: str, indent: str):
+        for i, child_id in enumerate(self.children[node_id]):
+            is_last = i == len(self.children[node_id]) - 1
+            yield child_id, f"{indent}{'└─╼' if is_last else '├─╼'} {child_id}"
+            yield from self._generate_child_text(
+                child_id, indent + ("    " if is_last else "│   ")
+            )
+
+    @classmethod
+    def from_node_link(cls, data: dict) -> "Graph":
+        graph = cls()
+        graph.graph.update(data["graph"])
+        for node in data["nodes"]:
+            graph.add_node(node["id"], **{k: v for k, v in node.items() if k != "id"})
+        for edge in data["edges"]:
+            graph.add_edge(edge["source"], edge["target"])
+        return graph
+
+    def to_node_link(self) -> dict:
+        # Same shape as networkx.node_link_data(graph, edges="edges")
+        return {
+            "directed": True,
+            "multigraph": False,
+            "graph": self.graph,
+            "nodes": [
+                {**attrs, "id": node_id} for node_id, attrs in self.nodes.items()
+            ],
+            "edges": [
+                {"source": parent_id, "target": child_id}
+                for parent_id, child_ids in self.children.items()
+                for child_id in child_ids
+            ],
+        }
+
+
 def run_command(*cmd: str, env: dict | None = None):
     logging.info("--> %s", " ".join(cmd))
     subprocess.check_call(cmd, env=env)
+    # Commands run here may move HEAD or rewrite branches
+    get_output.cache_clear()
+    _git_refs.cache_clear()
 
 
+@functools.lru_cache(maxsize=64)
 def get_output(cmd: tuple[str]) -> str:
-    return subprocess.check_output(cmd, stderr=subprocess.PIPE).decode("utf8")
+    return subprocess.check_output(cmd, stderr=subprocess.DEVNULL, encoding="utf8")
 
 
 @functools.cache
-def get_main_branch() -> tuple[str, str]:
-    try:
-        sha = get_output(("git", "rev-parse", "main")).strip()
-    except subprocess.CalledProcessError:
-        sha = get_output(("git", "rev-parse", "master")).strip()
-        branchname = "master"
+def _git_refs() -> tuple[str, str, str, str | None, dict[str, str]]:
+    # Every local branch with its sha and a "*" on HEAD, in one git process
+    output = get_output(
+        (
+            "git",
+            "for-each-ref",
+            "--format=%(HEAD) %(objectname) %(refname:lstrip=2)",
+            "refs/heads/",
+        )
+    )
+    branch_shas, head_branch = {}, "HEAD"
+    for line in output.splitlines():
+        sha, branch = line[2:].split(" ", 1)
+        branch_shas[branch] = sha
+        if line[0] == "*":
+            head_branch = branch
+    # A detached HEAD has no sha here, main() stops as soon as it sees one
+    head_sha = branch_shas.get(head_branch)
+    for main_branch in ("main", "master"):
+        if main_branch in branch_shas:
+            break
     else:
-        branchname = "main"
-    return branchname, sha
+        raise ValueError("Could not find main or master branch")
+    return main_branch, branch_shas[main_branch], head_branch, head_sha, branch_shas
 
 
-def get_head_branch() -> tuple[str, str]:
-    branchname = get_output(("git", "rev-parse", "--abbrev-ref", "HEAD")).strip()
-    sha = get_output(("git", "rev-parse", "HEAD")).strip()
-    return branchname, sha
+def get_main_branch() -> tuple[str, str]:
+    branchname, main_sha, _, _, _ = _git_refs()
+    return branchname, main_sha
 
 
-@functools.cache
-def get_sha_list() -> list[str]:
-    lines = get_output(("git", "rev-list", "HEAD")).split()
-    return lines
+def get_head_branch() -> tuple[str, str | None]:
+    _, _, head_branch, head_sha, _ = _git_refs()
+    return head_branch, head_sha
+
+
+def get_branch_shas() -> dict[str, str]:
+    _, _, _, _, branch_shas = _git_refs()
+    return branch_shas
+
+
+def get_sha_index(graph: Graph) -> dict[str, str]:
+    if graph.sha_index is None:
+        graph.sha_index = {graph.nodes[n]["sha"]: n for n in graph.nodes}
+    return graph.sha_index
+
+
+def set_branch_sha(graph: Graph, branch: str, sha: str):
+    graph.nodes[branch]["sha"] = sha
+    graph.sha_index = None
 
 
 @contextlib.contextmanager
 def read_graph():
-    if os.path.exists(".stack.json"):
+    try:
         with open(".stack.json", "r") as file:
-            graph = networkx.node_link_graph(json.load(file), edges="edges")
+            old_stack_json = file.read()
+    except FileNotFoundError:
+        old_stack_json, graph = None, Graph()
     else:
-        graph = networkx.DiGraph()
+        graph = Graph.from_node_link(json.loads(old_stack_json))
+    for graph_node in graph.nodes.values():
+        if "pull_url" in graph_node and "html_url" not in graph_node:
+            # Stacks submitted before html_url was kept on each node
+            graph_node["html_url"] = PR_PATTERN.sub(
+                r"https://github.com/\g<repo>/pull/\g<number>",
+                graph_node["pull_url"],
+            )
     main_branch, main_sha = get_main_branch()
     head_branch, head_sha = get_head_branch()
     graph.add_node(main_branch, sha=main_sha)
 
     yield graph
 
-    for line in networkx.generate_network_text(graph):
-        node_id = line.split(" ")[-1].strip()
-        graph_node = graph.nodes[node_id]
-        node_sha = graph_node["sha"]
-        prefix = "━━▶︎" if node_id == head_branch else "   "
-        if "pull_url" in graph_node:
-            pull_url = PR_PATTERN.sub(
-                r"https://github.com/\g<repo>/pull/\g<number>",
-                graph_node["pull_url"],
-            )
-            logging.info("%s %s ┈ %s ● %s", prefix, line, node_sha[:7], pull_url)
-        else:
-            logging.info("%s %s ┈ %s", prefix, line, node_sha[:7])
-    with open(".stack.json", "w") as file:
-        json.dump(networkx.node_link_data(graph, edges="edges"), file, indent=2)
-
-
-def update_branch(graph: networkx.DiGraph, head_branch: str, head_sha: str):
-    graph.nodes[head_branch]["sha"] = head_sha
-    for parent_branch in graph.predecessors(head_branch):
-        base_sha = get_output(("git", "merge-base", parent_branch, head_branch)).strip()
-        graph.nodes[head_branch]["base"] = base_sha
-
-
-def restack_branch(graph: networkx.DiGraph, head_branch: str, head_sha: str):
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        for node_id, line in graph.generate_network_text():
+            graph_node = graph.nodes[node_id]
+            node_sha = graph_node["sha"]
+            prefix = "━━▶︎" if node_id == head_branch else "   "
+            if html_url := graph_node.get("html_url"):
+                logging.info("%s %s ┈ %s ● %s", prefix, line, node_sha[:7], html_url)
+            else:
+                logging.info("%s %s ┈ %s", prefix, line, node_sha[:7])
+    new_stack_json = json.dumps(graph.to_node_link(), separators=(",", ":"))
+    if new_stack_json != old_stack_json:
+        with open(".stack.json", "w") as file:
+            file.write(new_stack_json)
+
+
+def get_merge_base(parent_branch: str, head_branch: str) -> str:
+    # Commits are immutable so merge bases are cached by sha across runs
+    branch_shas = get_branch_shas()
+    key = f"{branch_shas[parent_branch]} {branch_shas[head_branch]}"
+    cache_path = get_output(
+        ("git", "rev-parse", "--git-path", "stack-merge-base.json")
+    ).strip()
+    try:
+        with open(cache_path, "r") as file:
+            merge_bases = json.load(file)
+    except (FileNotFoundError, ValueError):
+        # A missing or damaged cache only costs a git merge-base
+        merge_bases = {}
+    most_recent = next(reversed(merge_bases), None) == key
+    if key in merge_bases:
+        merge_base = merge_bases.pop(key)
+    else:
+        merge_base = get_output(("git", "merge-base", *key.split())).strip()
+    # Keys are kept in order of use, so the oldest used fall off the front
+    merge_bases[key] = merge_base
+    if not most_recent:
+        recent = list(merge_bases.items())[-MERGE_BASE_CACHE_SIZE:]
+        temp_path = f"{cache_path}.{os.getpid()}"
+        with open(temp_path, "w") as file:
+            json.dump(dict(recent), file, separators=(",", ":"))
+        os.replace(temp_path, cache_path)
+    return merge_base
+
+
+def update_branch(graph: Graph, head_branch: str, head_sha: str):
+    set_branch_sha(graph, head_branch, head_sha)
+    if parent_branches := graph.predecessors(head_branch):
+        (parent_branch,) = parent_branches
+        graph.nodes[head_branch]["base"] = get_merge_base(parent_branch, head_branch)
+
+
+def restack_branch(graph: Graph, head_branch: str, head_sha: str):
     if graph.nodes[head_branch]["sha"] != head_sha:
         raise ValueError("Current branch SHA incorrect")
     (parent_branch,) = graph.predecessors(head_branch)
@@ -111,67 +289,147 @@ def restack_branch(graph: networkx.DiGraph, head_branch: str, head_sha: str):
     graph.nodes[head_branch]["base"] = new_base_sha
 
 
-def move_branch(
-    graph: networkx.DiGraph, head_branch: str, head_sha: str, new_parent: str
-):
-    if graph.nodes[head_branch]["sha"] != head_sha:
-        raise ValueError("Current branch SHA incorrect")
-    (parent_branch,) = graph.predecessors(head_branch)
-    logging.info("Move %s %s onto %s", head_branch, head_sha[:7], new_parent)
-    old_base_sha = graph.nodes[head_branch]["base"]
-    new_base_sha = graph.nodes[new_parent]["sha"]
-    try:
-        run_command("git", "rebase", "--onto", new_base_sha, old_base_sha, head_branch)
-    except subprocess.CalledProcessError as err:
-        logging.warning("****** Rebase error: %s ******", err)
-    else:
-        _, new_head_sha = get_head_branch()
-    graph.nodes[head_branch]["base"] = new_base_sha
-    graph.nodes[head_branch]["sha"] = new_head_sha
-    graph.remove_edge(parent_branch, head_branch)
-    graph.add_edge(new_parent, head_branch)
-
-    for child_head in list(graph.successors(head_branch)):
-        run_command("git", "checkout", child_head, env=dict(STACKY_STACKY="1"))
-        _, child_sha = get_head_branch()
-        move_branch(graph, child_head, child_sha, head_branch)
-
-    run_command("git", "checkout", head_branch, env=dict(STACKY_STACKY="1"))
-
-
-def add_branch(
-    graph: networkx.DiGraph, parent_sha: str, head_branch: str, head_sha: str
-):
-    graph_shas = {graph.nodes[node_id]["sha"]: node_id for node_id in graph.nodes}
-    logging.info(
-        "Add %s %s %s",
-        head_branch,
-        head_sha[:7],
-        {s[:7]: b for s, b in graph_shas.items()},
+def move_branch(graph: Graph, head_branch: str, head_sha: str, new_parent: str):
+    # Parents go first because each child is rebased onto its parent's new sha
+    moves, failed = [(head_branch, head_sha, new_parent)], False
+    for branch, branch_sha, onto_branch in moves:
+        if graph.nodes[branch]["sha"] != branch_sha:
+            raise ValueError(f"{branch} branch SHA incorrect")
+        (parent_branch,) = graph.predecessors(branch)
+        logging.info("Move %s %s onto %s", branch, branch_sha[:7], onto_branch)
+        old_base_sha = graph.nodes[branch]["base"]
+        new_base_sha = graph.nodes[onto_branch]["sha"]
+        try:
+            # Rebase checks out the named branch itself, no separate checkout
+            run_command("git", "rebase", "--onto", new_base_sha, old_base_sha, branch)
+        except subprocess.CalledProcessError as err:
+            # This branch and everything stacked on it stay where they were
+            logging.error("****** Rebase error: %s ******", err)
+            try:
+                run_command("git", "rebase", "--abort", env=dict(STACKY_STACKY="1"))
+            except subprocess.CalledProcessError:
+                logging.error("****** Could not abort rebase of %s ******", branch)
+                return 1
+            failed = True
+            break
+        _, new_branch_sha = get_head_branch()
+        graph.nodes[branch]["base"] = new_base_sha
+        set_branch_sha(graph, branch, new_branch_sha)
+        if parent_branch != onto_branch:
+            graph.remove_edge(parent_branch, branch)
+            graph.add_edge(onto_branch, branch)
+        for child_branch in graph.successors(branch):
+            moves.append((child_branch, get_branch_shas()[child_branch], branch))
+
+    if len(moves) > 1:
+        run_command("git", "checkout", head_branch, env=dict(STACKY_STACKY="1"))
+    if failed:
+        return 1
+
+
+def add_branch(graph: Graph, parent_sha: str, head_branch: str, head_sha: str):
+    graph_shas = get_sha_index(graph)
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        short_shas = {s[:7]: b for s, b in graph_shas.items()}
+        logging.info("Add %s %s %s", head_branch, head_sha[:7], short_shas)
+    # post-checkout passes the new HEAD, which needs no ancestry check
+    is_ancestor = ("git", "merge-base", "--is-ancestor", parent_sha, head_sha)
+    if parent_sha == head_sha or (
+        subprocess.call(is_ancestor, stderr=subprocess.DEVNULL) == 0
+    ):
+        graph.add_node(head_branch, sha=head_sha, base=parent_sha)
+        graph.add_edge(graph_shas[parent_sha], head_branch)
+
+
+@functools.cache
+def get_session() -> "requests.Session":
+    # Imported here so that hooks which never talk to Github skip the cost
+    import requests
+    import requests.adapters
+
+    session = requests.Session()
+    session.mount(
+        "https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    )
+    session.headers.update(
+        {
+            "Accept": "application/vnd.github+json",
+            "Authorization": f"Bearer {os.environ.get('GITHUB_TOKEN')}",
+        }
     )
-    for other_sha in get_sha_list():
-        if other_sha == head_sha:
-            graph.add_node(head_branch, sha=head_sha, base=other_sha)
-            graph.add_edge(graph_shas[parent_sha], head_branch)
+    return session
+
+
+def get_retry_delay(resp: "requests.Response", attempt: int) -> float:
+    if retry_after := resp.headers.get("retry-after"):
+        # Either a number of seconds or an HTTP date
+        if retry_after.isdigit():
+            return int(retry_after)
+        try:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            pass
+        else:
+            if retry_at.tzinfo is None:
+                retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+            return max(0, retry_at.timestamp() - time.time())
+    if resp.headers.get("x-ratelimit-remaining") == "0":
+        # Primary rate limit, nothing succeeds until the window resets
+        if (reset := resp.headers.get("x-ratelimit-reset", "")).isdigit():
+            return max(0, int(reset) - time.time())
+    return 2**attempt
+
+
+def github_request(method: str, url: str, **kwargs) -> "requests.Response":
+    for attempt in range(GITHUB_RETRIES):
+        resp = get_session().request(method, url, **kwargs)
+        rate_limited = resp.status_code == 429 or (
+            resp.status_code == 403
+            and (
+                "retry-after" in resp.headers
+                or resp.headers.get("x-ratelimit-remaining") == "0"
+            )
+        )
+        if not rate_limited or attempt == GITHUB_RETRIES - 1:
             break
+        delay = get_retry_delay(resp, attempt)
+        logging.warning("Github rate limit, retrying in %ds", delay)
+        time.sleep(delay)
+    return resp
+
+
+def github_graphql(query: str, variables: dict) -> dict:
+    resp = github_request(
+        "POST",
+        f"{args1.github}/graphql",
+        json={"query": query, "variables": variables},
+    )
+    if resp.status_code not in range(200, 299) or "errors" in resp.json():
+        raise ValueError(resp.text)
+    return resp.json()["data"]
 
 
-def submit_pull_request(graph: networkx.DiGraph, head_branch: str, title=None):
+@functools.cache
+def get_github_repo() -> str:
+    origin_url = get_output(("git", "remote", "get-url", "origin")).strip()
+    if matched := ORIGIN_PATTERN.search(origin_url):
+        return matched.group("repo")
+    raise ValueError("Could not find github.com origin")
+
+
+def submit_pull_request(graph: Graph, head_branch: str, title=None):
     (parent_branch,) = graph.predecessors(head_branch)
-    headers = {"Authorization": f"Bearer {os.environ.get('GITHUB_TOKEN')}"}
     if pull_url := graph.nodes[head_branch].get("pull_url"):
-        resp = requests.patch(
-            pull_url, json={"head": head_branch, "base": parent_branch}, headers=headers
+        resp = github_request(
+            "PATCH", pull_url, json={"head": head_branch, "base": parent_branch}
         )
         if resp.status_code not in range(200, 299):
             raise ValueError(resp.text)
     else:
-        if matched := ORIGIN_PATTERN.search(get_output(("git", "remote", "-v"))):
-            repo = matched.group("repo")
-        else:
-            raise ValueError("Could not find github.com origin")
+        repo = get_github_repo()
         for wanted_draft_mode in (True, False):
-            resp = requests.post(
+            resp = github_request(
+                "POST",
                 f"{args1.github}/repos/{repo}/pulls",
                 json={
                     "title": title or "Untitled Pull Request",
@@ -179,18 +437,72 @@ def submit_pull_request(graph: networkx.DiGraph, head_branch: str, title=None):
                     "base": parent_branch,
                     "draft": wanted_draft_mode,
                 },
-                headers=headers,
             )
             if wanted_draft_mode and resp.status_code == 422:
                 # Not all Github repos accept draft PRs
                 continue
+            elif resp.status_code not in range(200, 299):
+                raise ValueError(resp.text)
             else:
                 pull_url = urllib.parse.urljoin(args1.github, resp.json()["url"])
                 graph.nodes[head_branch]["pull_url"] = pull_url
+                graph.nodes[head_branch]["html_url"] = resp.json()["html_url"]
                 break
 
 
-def forget_branch(graph: networkx.DiGraph, head_branch: str, old_branch: str):
+def submit_stack(graph: Graph):
+    # Github asks that mutating calls are made serially, parents first
+    main_branch, _ = get_main_branch()
+    stack, failed = graph.descendants(main_branch), False
+    for head_branch in graph.topological_sort():
+        if head_branch not in stack:
+            continue
+        try:
+            submit_pull_request(graph, head_branch)
+        except (OSError, ValueError) as error:
+            # Keep going so pull requests made so far are saved to .stack.json
+            logging.error("Could not submit %s: %s", head_branch, error)
+            failed = True
+    if failed:
+        return 1
+
+
+def show_stack_status(graph: Graph):
+    pull_branches = [
+        node_id
+        for node_id in graph.topological_sort()
+        if "pull_url" in graph.nodes[node_id]
+    ]
+    if not pull_branches:
+        return
+    # Alias one pullRequest per branch so the whole stack is a single request
+    pull_fields = []
+    for i, branch in enumerate(pull_branches):
+        number = graph.nodes[branch]["pull_url"].rsplit("/", 1)[1]
+        pull_fields.append(
+            f"b{i}: pullRequest(number: {number})"
+            " { url state mergeable baseRefName headRefName }"
+        )
+    owner, name = get_github_repo().split("/")
+    data = github_graphql(
+        "query($owner: String!, $name: String!) {"
+        f" repository(owner: $owner, name: $name) {{ {' '.join(pull_fields)} }} }}",
+        {"owner": owner, "name": name},
+    )
+    for i, branch in enumerate(pull_branches):
+        pull = data["repository"][f"b{i}"]
+        (parent_branch,) = graph.predecessors(branch)
+        logging.info("%s: %s %s", branch, pull["state"], pull["mergeable"])
+        if pull["baseRefName"] != parent_branch:
+            logging.warning(
+                "%s: pull request is based on %s, stack has %s",
+                branch,
+                pull["baseRefName"],
+                parent_branch,
+            )
+
+
+def forget_branch(graph: Graph, head_branch: str, old_branch: str):
     if old_branch == head_branch:
         raise ValueError(f"Can't forget {old_branch} while on {head_branch}")
     for child_head in list(graph.successors(old_branch)):
@@ -201,10 +513,13 @@ def forget_branch(graph: networkx.DiGraph, head_branch: str, old_branch: str):
 def main(args1: argparse.Namespace, args2: list[str]):
     if "STACKY_STACKY" in os.environ:
         return
+    if args1.action == Actions.post_checkout and args2[-1:] != ["1"]:
+        # File checkouts leave HEAD where it was
+        return
+    if get_head_branch()[0] == "HEAD":
+        return
     with read_graph() as graph:
         head_branch, head_sha = get_head_branch()
-        if head_branch == "HEAD":
-            return
         if head_branch in graph.nodes:
             update_branch(graph, head_branch, head_sha)
         if args1.action == Actions.restack:
@@ -214,10 +529,17 @@ def main(args1: argparse.Namespace, args2: list[str]):
             (new_parent,) = args2
             assert new_parent in graph.nodes, f"Should know {new_parent}"
             assert head_branch in graph.nodes, f"Should know {head_branch}"
-            move_branch(graph, head_branch, head_sha, new_parent)
+            return move_branch(graph, head_branch, head_sha, new_parent)
         elif args1.action == Actions.submit:
             assert head_branch in graph.nodes, f"Should know {head_branch}"
             submit_pull_request(graph, head_branch, *args2)
+        elif args1.action == Actions.submit_stack:
+            return submit_stack(graph)
+        elif args1.action == Actions.status:
+            show_stack_status(graph)
+        elif args1.action == Actions.inspect:
+            # .stack.json is written compactly, this is the readable version
+            print(json.dumps(graph.to_node_link(), indent=2))
         elif args1.action == Actions.forget:
             (old_branch,) = args2
             assert old_branch in graph.nodes, f"Should know {old_branch}"
@@ -237,4 +559,4 @@ parser.add_argument("--github", default="https://api.github.com")
 if __name__ == "__main__":
     args1, args2 = parser.parse_known_args()
     logging.basicConfig(level=logging.INFO, format="%(message)s")
-    exit(main(args1, args2))
+    sys.exit(main(args1, args2))
@@ -1,9 +1,13 @@
+import atexit
 import contextlib
+import functools
 import json
 import http.server
 import itertools
 import os
+import re
 import shlex
+import shutil
 import subprocess
 import sys
 import tempfile
@@ -11,199 +15,376 @@ import threading
 import unittest
 import uuid
 
-import networkx
+import stack
 
 
-PYTHON_STACK_PY = "{0} {1}".format(
-    shlex.quote(sys.executable),
-    shlex.quote(os.path.join(os.path.dirname(__file__), "stack.py")),
+PYTHON_STACK_ARGV = (
+    sys.executable,
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "stack.py"),
 )
+PYTHON_STACK_PY = shlex.join(PYTHON_STACK_ARGV)
+
+# Keep test repos on tmpfs where there is one that allows running hooks
+TEMP_DIR = (
+    "/dev/shm"
+    if os.access("/dev/shm", os.W_OK)
+    and not os.statvfs("/dev/shm").f_flag & os.ST_NOEXEC
+    else None
+)
+
+# Longest shebang line that older kernels read in full
+SHEBANG_MAX = 127
+
+# Hooks run stack.py inside the hook's own Python, with no shell between.
+# They only need the standard library, so skip site-packages with -S.
+HOOK_SCRIPT = """import os, runpy, sys
+if "STACKY_STACKY" not in os.environ:
+    sys.argv[:2] = [{0!r}, {1!r}]
+    runpy.run_path(sys.argv[0], run_name="__main__")
+"""
 
 
-def run_cmd(cmd: str, quiet=True):
-    pipe_kwargs = dict(stderr=subprocess.PIPE, stdout=subprocess.PIPE) if quiet else {}
+def run_cmd(repodir: str, cmd: str, quiet=True):
+    pipe_kwargs = (
+        dict(stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL) if quiet else {}
+    )
+    # No shell, and only PATH so user git config and tokens don't leak in
+    env = {"PATH": os.environ.get("PATH", os.defpath)}
     for line in cmd.strip().split("\n"):
-        command = line.strip()
-        if command.startswith("git push origin "):
+        args = shlex.split(line)
+        if args[:3] == ["git", "push", "origin"]:
             # Skip these, there is nowhere to push to
             continue
-        subprocess.check_call(command, shell=True, env={}, **pipe_kwargs)
+        subprocess.check_call(args, cwd=repodir, env=env, **pipe_kwargs)
+
+
+def get_output(repodir: str, *cmd: str):
+    return subprocess.check_output(cmd, cwd=repodir, stderr=subprocess.DEVNULL).decode(
+        "utf8"
+    )
 
 
-def get_output(*cmd: str):
-    return subprocess.check_output(cmd, stderr=subprocess.PIPE).decode("utf8")
+def get_stderr(repodir: str, *cmd: str):
+    return subprocess.run(cmd, cwd=repodir, capture_output=True, text=True).stderr
 
 
-def get_git_log():
-    return get_output("git", "log", "--pretty=%s (%D)").strip().split("\n")
+def get_git_log(repodir: str):
+    return get_output(repodir, "git", "log", "--pretty=%s (%D)").strip().split("\n")
 
 
-def get_stack_graph():
-    with open(".stack.json") as file:
-        graph = networkx.node_link_graph(json.load(file), edges="edges")
+def get_stack_graph(repodir: str):
+    with open(os.path.join(repodir, ".stack.json")) as file:
+        graph = stack.Graph.from_node_link(json.load(file))
     return graph
 
 
-def add_hooks(repodir):
-    with open(os.path.join(repodir, ".git/hooks/post-commit"), "w") as hook_ci:
-        hook_ci.write(f"#!/bin/bash -ex\n{PYTHON_STACK_PY} post-commit")
-    with open(os.path.join(repodir, ".git/hooks/post-checkout"), "w") as hook_co:
-        hook_co.write(f"#!/bin/bash -ex\n{PYTHON_STACK_PY} post-checkout $2 $3")
-    os.chmod(hook_ci.name, 0o775)
-    os.chmod(hook_co.name, 0o775)
+def add_config(repodir):
+    # Same as git remote add and git config, without more git processes
+    with open(os.path.join(repodir, ".git/config"), "a") as config:
+        config.write(
+            '[remote "origin"]\n'
+            "\turl = git@github.com:migurski/temp.git\n"
+            "\tfetch = +refs/heads/*:refs/remotes/origin/*\n"
+            # Test repos are thrown away, so skip durability and upkeep
+            f"[core]\n\tfsync = none\n\thooksPath = {hooks_dir()}\n"
+            "[gc]\n\tauto = 0\n"
+            "[commit]\n\tgpgsign = false\n"
+        )
+
+
+def hook_script(code: str) -> str:
+    shebang = f"#!{sys.executable} -S"
+    if " " not in sys.executable and len(shebang) <= SHEBANG_MAX:
+        return f"{shebang}\n{code}"
+    # The kernel would split or cut this shebang, so let sh start Python
+    exe, code = shlex.quote(sys.executable), shlex.quote(code)
+    return f'#!/bin/sh\nexec {exe} -S -c {code} "$@"\n'
+
+
+def add_hooks(hooksdir):
+    for hook in ("post-commit", "post-checkout"):
+        with open(os.path.join(hooksdir, hook), "w") as file:
+            file.write(hook_script(HOOK_SCRIPT.format(PYTHON_STACK_ARGV[1], hook)))
+        os.chmod(file.name, 0o775)
+
+
+@functools.cache
+def hooks_dir():
+    # Every test repo points core.hooksPath here
+    hooksdir = tempfile.mkdtemp(dir=TEMP_DIR)
+    atexit.register(shutil.rmtree, hooksdir, ignore_errors=True)
+    add_hooks(hooksdir)
+    return hooksdir
+
+
+@functools.cache
+def template_repo():
+    repodir = tempfile.mkdtemp(dir=TEMP_DIR)
+    atexit.register(shutil.rmtree, repodir, ignore_errors=True)
+    # No template, so there are no sample hooks or other files to link
+    run_cmd(repodir, "git init --quiet --template= --initial-branch=main")
+    add_config(repodir)
+    return repodir
 
 
 @contextlib.contextmanager
 def fresh_repo():
-    with tempfile.TemporaryDirectory() as tempdir:
-        os.chdir(tempdir)
-        run_cmd("git init")
-        run_cmd("git remote add origin git@github.com:migurski/temp.git")
-        add_hooks(tempdir)
+    with tempfile.TemporaryDirectory(dir=TEMP_DIR) as tempdir:
+        # Git replaces files in .git rather than editing them, so links are safe
+        shutil.copytree(
+            template_repo(), tempdir, dirs_exist_ok=True, copy_function=os.link
+        )
         yield tempdir
 
 
-@contextlib.contextmanager
-def mock_github():
+class FakeGithub(http.server.BaseHTTPRequestHandler):
+    # Small responses shouldn't wait on Nagle; HTTP/1.0 closes after each one
+    disable_nagle_algorithm = True
+    protocol_version = "HTTP/1.0"
+    state = {}
+    counter = itertools.count(1)
     requests = []
+    rate_limits = 0
+    failing_heads = set()
+
+    @classmethod
+    def reset(cls):
+        cls.state, cls.counter, cls.requests = {}, itertools.count(1), []
+        cls.rate_limits, cls.failing_heads = 0, set()
+
+    def read_json_request(self):
+        return json.loads(self.rfile.read(int(self.headers.get("Content-Length"))))
+
+    def write_json_response(self, code, data, headers=None):
+        body = json.dumps(data).encode("utf8")
+        self.send_response(code)
+        self.send_header("Content-type", "application/json")
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PATCH(self):
+        input = self.read_json_request()
+        if state := self.state.get(self.path):
+            code, resp = 200, {"url": self.path}
+            self.state[self.path] = {**self.state[self.path], **input}
+        else:
+            code, resp = 422, {}
+        self.requests.append((self.command, self.path, input))
+        self.write_json_response(code, resp)
+
+    def query_pulls(self, input):
+        pulls, repo = {}, "{owner}/{name}".format(**input["variables"])
+        for alias, number in re.findall(
+            r"(\w+): pullRequest\(number: (\d+)\)", input["query"]
+        ):
+            url = f"/repos/{repo}/pull/{number}"
+            pulls[alias] = {
+                "url": url,
+                "state": "OPEN",
+                "mergeable": "MERGEABLE",
+                "baseRefName": self.state[url]["base"],
+                "headRefName": self.state[url]["head"],
+            }
+        return pulls
+
+    def write_rate_limited(self, input):
+        FakeGithub.rate_limits -= 1
+        self.requests.append((self.command, self.path, input))
+        message = {"message": "API rate limit exceeded"}
+        self.write_json_response(429, message, {"Retry-After": "0"})
+
+    def do_POST(self):
+        input = self.read_json_request()
+        if self.rate_limits:
+            return self.write_rate_limited(input)
+        if input.get("head") in self.failing_heads:
+            code, resp = 500, {"message": "Server Error"}
+        elif self.path == "/repos/migurski/temp/pulls":
+            number = next(self.counter)
+            url = f"/repos/migurski/temp/pull/{number}"
+            html_url = f"https://github.com/migurski/temp/pull/{number}"
+            code, resp = 200, {"url": url, "html_url": html_url}
+            self.state[url] = input
+        elif self.path == "/graphql":
+            code, resp = 200, {"data": {"repository": self.query_pulls(input)}}
+        else:
+            code, resp = 422, {}
+        self.requests.append((self.command, self.path, input))
+        self.write_json_response(code, resp)
+
 
-    class FakeGithub(http.server.BaseHTTPRequestHandler):
-        state = {}
-        counter = itertools.count(1)
-
-        def read_json_request(self):
-            return json.loads(self.rfile.read(int(self.headers.get("Content-Length"))))
-
-        def write_json_response(self, code, data):
-            self.send_response(code)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(json.dumps(data).encode("utf8"))
-
-        def do_PATCH(self):
-            input = self.read_json_request()
-            if state := self.state.get(self.path):
-                code, resp = 200, {"url": self.path}
-                self.state[self.path] = {**self.state[self.path], **input}
-            else:
-                code, resp = 422, {}
-            requests.append((self.command, self.path, input))
-            self.write_json_response(code, resp)
-
-        def do_POST(self):
-            input = self.read_json_request()
-            if self.path == "/repos/migurski/temp/pulls":
-                url = f"/repos/migurski/temp/pull/{next(self.counter)}"
-                code, resp = 200, {"url": url}
-                self.state[url] = input
-            else:
-                code, resp = 422, {}
-            requests.append((self.command, self.path, input))
-            self.write_json_response(code, resp)
+# One server for the whole module, bound to whatever port the OS hands out
+server = http.server.ThreadingHTTPServer(("localhost", 0), FakeGithub)
 
+
+def setUpModule():
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def tearDownModule():
+    server.shutdown()
+    server.server_close()
+
+
+@contextlib.contextmanager
+def mock_github():
+    FakeGithub.reset()
     old_token, os.environ["GITHUB_TOKEN"] = os.getenv("GITHUB_TOKEN"), str(uuid.uuid4())
+    github_url = "http://localhost:{1}".format(*server.server_address)
 
-    for port in range(8000, 8099):
-        try:
-            server = http.server.HTTPServer(("", port), FakeGithub)
-        except OSError:
-            continue
+    try:
+        yield github_url, os.environ["GITHUB_TOKEN"], FakeGithub.requests
+    finally:
+        if old_token is not None:
+            os.environ["GITHUB_TOKEN"] = old_token
         else:
-            threading.Thread(target=server.serve_forever).start()
-            try:
-                yield f"http://localhost:{port}", os.environ["GITHUB_TOKEN"], requests
-            finally:
-                server.server_close()
-                server.shutdown()
-                break
-
-    if old_token is not None:
-        os.environ["GITHUB_TOKEN"] = old_token
-    else:
-        del os.environ["GITHUB_TOKEN"]
+            del os.environ["GITHUB_TOKEN"]
 
 
 class TestRepo(unittest.TestCase):
     def test_one_branch(self):
-        with fresh_repo():
-            run_cmd("git commit -m 'empty' --allow-empty")
-            graph = get_stack_graph()
+        with fresh_repo() as repo:
+            run_cmd(repo, "git commit -m 'empty' --allow-empty")
+            graph = get_stack_graph(repo)
         self.assertEqual(len(graph.nodes), 1)
 
-    def test_one_branch_subdir1(self):
+    def test_one_branch_subdir(self):
         """We're inside a subdirectory"""
-        with fresh_repo():
-            os.mkdir("subdir")
-            os.chdir("subdir")
-            run_cmd("git commit -m two --allow-empty")
-            os.chdir("..")
-            graph = get_stack_graph()
-        self.assertEqual(len(graph.nodes), 1)
-
-    def test_one_branch_subdir2(self):
-        """We're inside a subdirectory"""
-        with fresh_repo():
-            os.mkdir("subdir")
-            os.chdir("subdir")
-            run_cmd("git commit -m two --allow-empty")
-            os.chdir("..")
-            graph = get_stack_graph()
+        with fresh_repo() as repo:
+            subdir = os.path.join(repo, "subdir")
+            os.mkdir(subdir)
+            run_cmd(subdir, "git commit -m two --allow-empty")
+            graph = get_stack_graph(repo)
         self.assertEqual(len(graph.nodes), 1)
 
     def test_two_branches(self):
         """One branch simply extends main"""
-        with fresh_repo():
-            run_cmd("""
+        with fresh_repo() as repo:
+            run_cmd(
+                repo,
+                """
                 git commit -m one --allow-empty
                 git checkout -b branch/1
                 git commit -m two --allow-empty
                 git checkout main
-                """)
-            graph = get_stack_graph()
+                """,
+            )
+            graph = get_stack_graph(repo)
+        self.assertEqual(len(graph.nodes), 2)
+        self.assertEqual(list(graph.successors("main")), ["branch/1"])
+        self.assertEqual(graph.nodes["branch/1"]["base"], graph.nodes["main"]["sha"])
+
+    def test_two_branches_tag_names(self):
+        """Tags share their names with both branches"""
+        with fresh_repo() as repo:
+            run_cmd(
+                repo,
+                """
+                git commit -m one --allow-empty
+                git tag main
+                git tag branch/1
+                git checkout -b branch/1
+                git commit -m two --allow-empty
+                git checkout main
+                """,
+            )
+            graph = get_stack_graph(repo)
         self.assertEqual(len(graph.nodes), 2)
         self.assertEqual(list(graph.successors("main")), ["branch/1"])
         self.assertEqual(graph.nodes["branch/1"]["base"], graph.nodes["main"]["sha"])
 
     def test_two_branches_subdir1(self):
         """One branch simply extends main and we're inside a subdirectory"""
-        with fresh_repo():
-            run_cmd("""
+        with fresh_repo() as repo:
+            run_cmd(
+                repo,
+                """
                 git commit -m one --allow-empty
                 git checkout -b branch/1
-                """)
-            os.mkdir("subdir")
-            os.chdir("subdir")
-            run_cmd("""
+                """,
+            )
+            subdir = os.path.join(repo, "subdir")
+            os.mkdir(subdir)
+            run_cmd(
+                subdir,
+                """
                 git commit -m two --allow-empty
                 git checkout main
-                """)
-            os.chdir("..")
-            graph = get_stack_graph()
+                """,
+            )
+            graph = get_stack_graph(repo)
         self.assertEqual(len(graph.nodes), 2)
         self.assertEqual(list(graph.successors("main")), ["branch/1"])
         self.assertEqual(graph.nodes["branch/1"]["base"], graph.nodes["main"]["sha"])
 
     def test_two_branches_subdir2(self):
         """One branch simply extends main and we're inside a subdirectory"""
-        with fresh_repo():
-            os.mkdir("subdir")
-            os.chdir("subdir")
-            run_cmd("""
+        with fresh_repo() as repo:
+            subdir = os.path.join(repo, "subdir")
+            os.mkdir(subdir)
+            run_cmd(
+                subdir,
+                """
                 git commit -m one --allow-empty
                 git checkout -b branch/1
                 git commit -m two --allow-empty
                 git checkout main
-                """)
-            os.chdir("..")
-            graph = get_stack_graph()
+                """,
+            )
+            graph = get_stack_graph(repo)
         self.assertEqual(len(graph.nodes), 2)
         self.assertEqual(list(graph.successors("main")), ["branch/1"])
         self.assertEqual(graph.nodes["branch/1"]["base"], graph.nodes["main"]["sha"])
 
+    def test_two_branches_merge_base_cached(self):
+        """Known merge bases are read from the cache instead of git"""
+        with fresh_repo() as repo:
+            run_cmd(
+                repo,
+                """
+                git commit -m one --allow-empty
+                git checkout -b branch/1
+                git commit -m two --allow-empty
+                git checkout main
+                """,
+            )
+            cache_path = os.path.join(repo, ".git/stack-merge-base.json")
+            with open(cache_path) as file:
+                merge_bases = json.load(file)
+            # Only a cache hit could produce this base
+            fake_base = "f" * 40
+            with open(cache_path, "w") as file:
+                json.dump({key: fake_base for key in merge_bases}, file)
+            run_cmd(repo, "git checkout branch/1")
+            graph = get_stack_graph(repo)
+            in_worktree = os.path.exists(os.path.join(repo, ".stack-merge-base.json"))
+        self.assertEqual(len(merge_bases), 1)
+        self.assertEqual(graph.nodes["branch/1"]["base"], fake_base)
+        self.assertFalse(in_worktree)
+
+    def test_two_branches_merge_base_corrupt(self):
+        """A damaged merge base cache is rebuilt"""
+        with fresh_repo() as repo:
+            run_cmd(repo, "git commit -m one --allow-empty\ngit checkout -b branch/1")
+            cache_path = os.path.join(repo, ".git/stack-merge-base.json")
+            with open(cache_path, "w") as file:
+                file.write('{"trunc')
+            run_cmd(repo, "git commit -m two --allow-empty")
+            graph = get_stack_graph(repo)
+            with open(cache_path) as file:
+                merge_bases = json.load(file)
+        self.assertEqual(graph.nodes["branch/1"]["base"], graph.nodes["main"]["sha"])
+        self.assertEqual(list(merge_bases.values()), [graph.nodes["main"]["sha"]])
+
     def test_two_branches_no_ff(self):
         """One branch diverges slightly from main"""
-        with fresh_repo():
-            run_cmd("""
+        with fresh_repo() as repo:
+            run_cmd(
+                repo,
+                """
                 git commit -m one --allow-empty
                 git checkout -b branch/1
                 git commit -m two --allow-empty
@@ -211,16 +392,19 @@ class TestRepo(unittest.TestCase):
                 git commit -m three --allow-empty
                 git checkout branch/1
                 git commit -m four --allow-empty
-                """)
-            graph = get_stack_graph()
+                """,
+            )
+            graph = get_stack_graph(repo)
         self.assertEqual(len(graph.nodes), 2)
         self.assertEqual(list(graph.successors("main")), ["branch/1"])
         self.assertNotEqual(graph.nodes["branch/1"]["base"], graph.nodes["main"]["sha"])
 
     def test_two_branches_ff_ok(self):
         """One branch simply extends main after a merge"""
-        with fresh_repo():
-            run_cmd("""
+        with fresh_repo() as repo:
+            run_cmd(
+                repo,
+                """
                 git commit -m one --allow-empty
                 git checkout -b branch/1
                 git checkout main
@@ -228,16 +412,19 @@ class TestRepo(unittest.TestCase):
                 git checkout branch/1
                 git merge main
                 git commit -m three --allow-empty
-                """)
-            graph = get_stack_graph()
+                """,
+            )
+            graph = get_stack_graph(repo)
         self.assertEqual(len(graph.nodes), 2)
         self.assertEqual(list(graph.successors("main")), ["branch/1"])
         self.assertEqual(graph.nodes["branch/1"]["base"], graph.nodes["main"]["sha"])
 
     def test_two_branches_restack(self):
         """One branch restacked after changes to main"""
-        with fresh_repo():
-            run_cmd(f"""
+        with fresh_repo() as repo:
+            run_cmd(
+                repo,
+                f"""
                 git commit -m one --allow-empty
                 git checkout -b branch/1
                 git commit -m two --allow-empty
@@ -246,8 +433,9 @@ class TestRepo(unittest.TestCase):
                 git checkout branch/1
                 git commit -m four --allow-empty
                 {PYTHON_STACK_PY} restack
-                """)
-            log, graph = get_git_log(), get_stack_graph()
+                """,
+            )
+            log, graph = get_git_log(repo), get_stack_graph(repo)
 
         self.assertEqual(len(log), 4)
         self.assertEqual(
@@ -260,16 +448,19 @@ class TestRepo(unittest.TestCase):
 
     def test_three_branches(self):
         """Two branches diverge slightly from main"""
-        with fresh_repo():
-            run_cmd(f"""
+        with fresh_repo() as repo:
+            run_cmd(
+                repo,
+                f"""
                 git commit -m one --allow-empty
                 git checkout -b branch/1
                 git commit -m two --allow-empty
                 git checkout main
                 git checkout -b branch/2
                 git commit -m three --allow-empty
-                """)
-            log, graph = get_git_log(), get_stack_graph()
+                """,
+            )
+            log, graph = get_git_log(repo), get_stack_graph(repo)
 
         self.assertEqual(len(log), 2)
         self.assertEqual(log, ["three (HEAD -> branch/2)", "one (main)"])
@@ -281,15 +472,18 @@ class TestRepo(unittest.TestCase):
 
     def test_three_branches_skipstep(self):
         """Two branches diverge slightly from main"""
-        with fresh_repo():
-            run_cmd(f"""
+        with fresh_repo() as repo:
+            run_cmd(
+                repo,
+                f"""
                 git commit -m one --allow-empty
                 git checkout -b branch/1
                 git commit -m two --allow-empty
                 git checkout -b branch/2 main
                 git commit -m three --allow-empty
-                """)
-            log, graph = get_git_log(), get_stack_graph()
+                """,
+            )
+            log, graph = get_git_log(repo), get_stack_graph(repo)
 
         self.assertEqual(len(log), 2)
         self.assertEqual(log, ["three (HEAD -> branch/2)", "one (main)"])
@@ -301,15 +495,18 @@ class TestRepo(unittest.TestCase):
 
     def test_three_branches_stacked(self):
         """Two branches stacked atop main in sequence"""
-        with fresh_repo():
-            run_cmd(f"""
+        with fresh_repo() as repo:
+            run_cmd(
+                repo,
+                f"""
                 git commit -m one --allow-empty
                 git checkout -b br/1
                 git commit -m two --allow-empty
                 git checkout -b br/2
                 git commit -m three --allow-empty
-                """)
-            log, graph = get_git_log(), get_stack_graph()
+                """,
+            )
+            log, graph = get_git_log(repo), get_stack_graph(repo)
 
         self.assertEqual(len(log), 3)
         self.assertEqual(log, ["three (HEAD -> br/2)", "two (br/1)", "one (main)"])
@@ -322,16 +519,19 @@ class TestRepo(unittest.TestCase):
 
     def test_two_branches_move_up_onto(self):
         """One branch moved onto another"""
-        with fresh_repo():
-            run_cmd(f"""
+        with fresh_repo() as repo:
+            run_cmd(
+                repo,
+                f"""
                 git commit -m one --allow-empty
                 git checkout -b br/1
                 git commit -m two --allow-empty
                 git checkout -b br/2 main
                 git commit -m three --allow-empty
                 {PYTHON_STACK_PY} move-onto br/1
-                """)
-            log, graph = get_git_log(), get_stack_graph()
+                """,
+            )
+            log, graph = get_git_log(repo), get_stack_graph(repo)
 
         self.assertEqual(len(log), 3)
         self.assertEqual(log, ["three (HEAD -> br/2)", "two (br/1)", "one (main)"])
@@ -344,16 +544,19 @@ class TestRepo(unittest.TestCase):
 
     def test_two_branches_move_down_onto(self):
         """One branch moved onto another"""
-        with fresh_repo():
-            run_cmd(f"""
+        with fresh_repo() as repo:
+            run_cmd(
+                repo,
+                f"""
                 git commit -m one --allow-empty
                 git checkout -b br/1
                 git commit -m two --allow-empty
                 git checkout -b br/2
                 git commit -m three --allow-empty
                 {PYTHON_STACK_PY} move-onto main
-                """)
-            log, graph = get_git_log(), get_stack_graph()
+                """,
+            )
+            log, graph = get_git_log(repo), get_stack_graph(repo)
 
         self.assertEqual(len(log), 2)
         self.assertEqual(log, ["three (HEAD -> br/2)", "one (main)"])
@@ -365,8 +568,10 @@ class TestRepo(unittest.TestCase):
 
     def test_three_branches_move_onto(self):
         """One stack moved onto another"""
-        with fresh_repo():
-            run_cmd(f"""
+        with fresh_repo() as repo:
+            run_cmd(
+                repo,
+                f"""
                 git commit -m zero --allow-empty
                 git checkout -b br/1
                 git commit -m one --allow-empty
@@ -377,8 +582,9 @@ class TestRepo(unittest.TestCase):
                 git checkout br/2
                 {PYTHON_STACK_PY} move-onto main
                 git checkout br/3
-                """)
-            log, graph = get_git_log(), get_stack_graph()
+                """,
+            )
+            log, graph = get_git_log(repo), get_stack_graph(repo)
 
         self.assertEqual(len(log), 3)
         self.assertEqual(log, ["three (HEAD -> br/3)", "two (br/2)", "zero (main)"])
@@ -389,18 +595,84 @@ class TestRepo(unittest.TestCase):
         self.assertEqual(graph.nodes["br/2"]["base"], graph.nodes["main"]["sha"])
         self.assertEqual(graph.nodes["br/3"]["base"], graph.nodes["br/2"]["sha"])
 
+    def test_two_branches_move_onto_conflict(self):
+        """Conflicting move leaves the stack alone"""
+        with fresh_repo() as repo:
+            run_cmd(repo, "git commit -m one --allow-empty\ngit checkout -b br/1")
+            with open(os.path.join(repo, "u"), "w") as file:
+                file.write("branch\n")
+            run_cmd(repo, "git add u\ngit commit -m two\ngit checkout main")
+            with open(os.path.join(repo, "u"), "w") as file:
+                file.write("main\n")
+            run_cmd(repo, "git add u\ngit commit -m three\ngit checkout br/1")
+            with open(os.path.join(repo, ".stack.json")) as file:
+                old_stack_json = file.read()
+            with self.assertRaises(subprocess.CalledProcessError):
+                run_cmd(repo, f"{PYTHON_STACK_PY} move-onto main")
+            log = get_git_log(repo)
+            with open(os.path.join(repo, ".stack.json")) as file:
+                new_stack_json = file.read()
+
+        self.assertEqual(log, ["two (HEAD -> br/1)", "one ()"])
+        self.assertEqual(new_stack_json, old_stack_json)
+
+    def test_four_branches_move_onto_blocked(self):
+        """Blocked child rebase stops the move at that child"""
+        with fresh_repo() as repo:
+            run_cmd(
+                repo,
+                """
+                git commit -m one --allow-empty
+                git checkout -b br/1
+                git commit -m two --allow-empty
+                git checkout -b br/2
+                """,
+            )
+            with open(os.path.join(repo, "u"), "w") as file:
+                file.write("tracked\n")
+            run_cmd(
+                repo,
+                """
+                git add u
+                git commit -m three
+                git checkout -b br/3
+                git rm u
+                git commit -m four
+                git checkout main
+                git commit -m five --allow-empty
+                git checkout br/1
+                """,
+            )
+            # Untracked file in the way of checking out br/2
+            with open(os.path.join(repo, "u"), "w") as file:
+                file.write("untracked\n")
+            old_graph = get_stack_graph(repo)
+            with self.assertRaises(subprocess.CalledProcessError):
+                run_cmd(repo, f"{PYTHON_STACK_PY} move-onto main")
+            graph = get_stack_graph(repo)
+            refs = get_output(repo, "git", "rev-parse", "br/2", "br/3").split()
+
+        self.assertEqual(graph.nodes["br/1"]["base"], graph.nodes["main"]["sha"])
+        self.assertEqual(graph.nodes["br/2"], old_graph.nodes["br/2"])
+        self.assertEqual(graph.nodes["br/3"], old_graph.nodes["br/3"])
+        self.assertEqual(refs, [graph.nodes["br/2"]["sha"], graph.nodes["br/3"]["sha"]])
+        self.assertEqual(list(graph.successors("br/1")), ["br/2"])
+
     def test_one_branch_submit_1x(self):
         """One branch submitted to Github"""
-        with fresh_repo():
+        with fresh_repo() as repo:
             with mock_github() as (github_url, _, github_requests):
-                run_cmd(f"""
+                run_cmd(
+                    repo,
+                    f"""
                     git commit -m one --allow-empty
                     git checkout -b br/1
                     git commit -m two --allow-empty
                     git push origin br/1
                     {PYTHON_STACK_PY} submit --github {github_url} "PR 1"
-                    """)
-                log, graph = get_git_log(), get_stack_graph()
+                    """,
+                )
+                log, graph = get_git_log(repo), get_stack_graph(repo)
 
         self.assertEqual(len(log), 2)
         self.assertEqual(log, ["two (HEAD -> br/1)", "one (main)"])
@@ -411,6 +683,9 @@ class TestRepo(unittest.TestCase):
         self.assertEqual(
             graph.nodes["br/1"]["pull_url"], f"{github_url}/repos/migurski/temp/pull/1"
         )
+        self.assertEqual(
+            graph.nodes["br/1"]["html_url"], "https://github.com/migurski/temp/pull/1"
+        )
 
         self.assertEqual(
             github_requests,
@@ -423,11 +698,62 @@ class TestRepo(unittest.TestCase):
             ],
         )
 
+    def test_one_branch_submit_rate_limited(self):
+        """One branch submitted to Github after a rate limit"""
+        with fresh_repo() as repo:
+            with mock_github() as (github_url, _, github_requests):
+                FakeGithub.rate_limits = 1
+                run_cmd(
+                    repo,
+                    f"""
+                    git commit -m one --allow-empty
+                    git checkout -b br/1
+                    git commit -m two --allow-empty
+                    {PYTHON_STACK_PY} submit --github {github_url} "PR 1"
+                    """,
+                )
+                graph = get_stack_graph(repo)
+
+        self.assertEqual(
+            graph.nodes["br/1"]["pull_url"], f"{github_url}/repos/migurski/temp/pull/1"
+        )
+        pull_request = (
+            "POST",
+            "/repos/migurski/temp/pulls",
+            {"base": "main", "head": "br/1", "title": "PR 1", "draft": True},
+        )
+        self.assertEqual(github_requests, [pull_request, pull_request])
+
+    def test_one_branch_submit_rate_limited_out(self):
+        """One branch not submitted to Github after every retry is rate limited"""
+        with fresh_repo() as repo:
+            with mock_github() as (github_url, _, github_requests):
+                FakeGithub.rate_limits = stack.GITHUB_RETRIES
+                run_cmd(
+                    repo,
+                    """
+                    git commit -m one --allow-empty
+                    git checkout -b br/1
+                    git commit -m two --allow-empty
+                    """,
+                )
+                stderr = get_stderr(
+                    repo, *PYTHON_STACK_ARGV, "submit", "--github", github_url, "PR 1"
+                )
+                graph = get_stack_graph(repo)
+
+        self.assertIn("API rate limit exceeded", stderr)
+        self.assertNotIn("KeyError", stderr)
+        self.assertNotIn("pull_url", graph.nodes["br/1"])
+        self.assertEqual(len(github_requests), stack.GITHUB_RETRIES)
+
     def test_one_branch_submit_2x(self):
         """One branch submitted to Github twice"""
-        with fresh_repo():
+        with fresh_repo() as repo:
             with mock_github() as (github_url, _, github_requests):
-                run_cmd(f"""
+                run_cmd(
+                    repo,
+                    f"""
                     git commit -m one --allow-empty
                     git checkout -b br/1
                     git commit -m two --allow-empty
@@ -438,8 +764,9 @@ class TestRepo(unittest.TestCase):
                     {PYTHON_STACK_PY} move-onto main
                     git push origin br/2
                     {PYTHON_STACK_PY} submit --github {github_url}
-                    """)
-                log, graph = get_git_log(), get_stack_graph()
+                    """,
+                )
+                log, graph = get_git_log(repo), get_stack_graph(repo)
 
         self.assertEqual(len(log), 2)
         self.assertEqual(log, ["three (HEAD -> br/2)", "one (main)"])
@@ -470,9 +797,11 @@ class TestRepo(unittest.TestCase):
 
     def test_two_branches_submit_1x(self):
         """Two branches submitted to Github once each"""
-        with fresh_repo():
+        with fresh_repo() as repo:
             with mock_github() as (github_url, _, github_requests):
-                run_cmd(f"""
+                run_cmd(
+                    repo,
+                    f"""
                     git commit -m one --allow-empty
                     git checkout -b br/1
                     git commit -m two --allow-empty
@@ -482,8 +811,9 @@ class TestRepo(unittest.TestCase):
                     git commit -m three --allow-empty
                     git push origin br/2
                     {PYTHON_STACK_PY} submit --github {github_url} "PR 2"
-                    """)
-                log, graph = get_git_log(), get_stack_graph()
+                    """,
+                )
+                log, graph = get_git_log(repo), get_stack_graph(repo)
 
         self.assertEqual(len(log), 3)
         self.assertEqual(log, ["three (HEAD -> br/2)", "two (br/1)", "one (main)"])
@@ -515,17 +845,204 @@ class TestRepo(unittest.TestCase):
             ],
         )
 
+    def test_two_branches_submit_stack(self):
+        """Two stacked branches submitted to Github together"""
+        with fresh_repo() as repo:
+            with mock_github() as (github_url, _, github_requests):
+                run_cmd(
+                    repo,
+                    f"""
+                    git commit -m one --allow-empty
+                    git checkout -b br/1
+                    git commit -m two --allow-empty
+                    git push origin br/1
+                    git checkout -b br/2
+                    git commit -m three --allow-empty
+                    git push origin br/2
+                    {PYTHON_STACK_PY} submit-stack --github {github_url}
+                    """,
+                )
+                log, graph = get_git_log(repo), get_stack_graph(repo)
+
+        self.assertEqual(len(log), 3)
+        self.assertEqual(log, ["three (HEAD -> br/2)", "two (br/1)", "one (main)"])
+
+        self.assertEqual(len(graph.nodes), 3)
+        self.assertEqual(
+            graph.nodes["br/1"]["pull_url"], f"{github_url}/repos/migurski/temp/pull/1"
+        )
+        self.assertEqual(
+            graph.nodes["br/2"]["pull_url"], f"{github_url}/repos/migurski/temp/pull/2"
+        )
+
+        untitled = "Untitled Pull Request"
+        self.assertEqual(
+            github_requests,
+            [
+                (
+                    "POST",
+                    "/repos/migurski/temp/pulls",
+                    {"base": "main", "head": "br/1", "title": untitled, "draft": True},
+                ),
+                (
+                    "POST",
+                    "/repos/migurski/temp/pulls",
+                    {"base": "br/1", "head": "br/2", "title": untitled, "draft": True},
+                ),
+            ],
+        )
+
+    def test_three_branches_submit_stack_failure(self):
+        """Three stacked branches submitted to Github with the middle one failing"""
+        with fresh_repo() as repo:
+            with mock_github() as (github_url, _, github_requests):
+                FakeGithub.failing_heads = {"br/2"}
+                run_cmd(
+                    repo,
+                    """
+                    git commit -m one --allow-empty
+                    git checkout -b br/1
+                    git commit -m two --allow-empty
+                    git checkout -b br/2
+                    git commit -m three --allow-empty
+                    git checkout -b br/3
+                    git commit -m four --allow-empty
+                    """,
+                )
+                stderr = get_stderr(
+                    repo, *PYTHON_STACK_ARGV, "submit-stack", "--github", github_url
+                )
+                graph = get_stack_graph(repo)
+
+        self.assertIn("Could not submit br/2", stderr)
+        self.assertIn("Server Error", stderr)
+        self.assertEqual(
+            graph.nodes["br/1"]["pull_url"], f"{github_url}/repos/migurski/temp/pull/1"
+        )
+        self.assertNotIn("pull_url", graph.nodes["br/2"])
+        self.assertEqual(
+            graph.nodes["br/3"]["pull_url"], f"{github_url}/repos/migurski/temp/pull/2"
+        )
+        self.assertEqual(
+            [input["head"] for _, _, input in github_requests], ["br/1", "br/2", "br/3"]
+        )
+
+    def test_two_branches_status(self):
+        """Two submitted branches checked on Github in one request"""
+        with fresh_repo() as repo:
+            with mock_github() as (github_url, _, github_requests):
+                run_cmd(
+                    repo,
+                    f"""
+                    git commit -m one --allow-empty
+                    git checkout -b br/1
+                    git commit -m two --allow-empty
+                    git checkout -b br/2
+                    git commit -m three --allow-empty
+                    {PYTHON_STACK_PY} submit-stack --github {github_url}
+                    {PYTHON_STACK_PY} status --github {github_url}
+                    """,
+                )
+
+        self.assertEqual(
+            [(method, path) for method, path, _ in github_requests],
+            [
+                ("POST", "/repos/migurski/temp/pulls"),
+                ("POST", "/repos/migurski/temp/pulls"),
+                ("POST", "/graphql"),
+            ],
+        )
+        _, _, graphql_request = github_requests[-1]
+        self.assertEqual(
+            graphql_request["variables"], {"owner": "migurski", "name": "temp"}
+        )
+        self.assertIn("b0: pullRequest(number: 1)", graphql_request["query"])
+        self.assertIn("b1: pullRequest(number: 2)", graphql_request["query"])
+
+    def test_two_branches_status_mismatch(self):
+        """Pull request based on the wrong branch is reported"""
+        with fresh_repo() as repo:
+            with mock_github() as (github_url, _, _):
+                run_cmd(
+                    repo,
+                    f"""
+                    git commit -m one --allow-empty
+                    git checkout -b br/1
+                    git commit -m two --allow-empty
+                    git checkout -b br/2
+                    git commit -m three --allow-empty
+                    {PYTHON_STACK_PY} submit-stack --github {github_url}
+                    """,
+                )
+                # Someone retargeted the second pull request on Github
+                FakeGithub.state["/repos/migurski/temp/pull/2"]["base"] = "main"
+                output = get_stderr(
+                    repo, *PYTHON_STACK_ARGV, "status", "--github", github_url
+                )
+
+        self.assertIn("br/1: OPEN MERGEABLE\n", output)
+        self.assertIn("br/2: OPEN MERGEABLE\n", output)
+        self.assertIn("br/2: pull request is based on main, stack has br/1\n", output)
+        self.assertNotIn("br/1: pull request is based on", output)
+
+    def test_two_branches_inspect(self):
+        """Stack printed as readable JSON on demand"""
+        with fresh_repo() as repo:
+            run_cmd(
+                repo,
+                """
+                git commit -m one --allow-empty
+                git checkout -b br/1
+                git commit -m two --allow-empty
+                """,
+            )
+            output = get_output(repo, *PYTHON_STACK_ARGV, "inspect")
+            with open(os.path.join(repo, ".stack.json")) as file:
+                stack_json = json.load(file)
+
+        self.assertEqual(json.loads(output), stack_json)
+        self.assertIn('\n  "nodes": [\n', output)
+
+    def test_three_branches_tree(self):
+        """Stack drawn as a tree with the current branch marked"""
+        with fresh_repo() as repo:
+            run_cmd(
+                repo,
+                """
+                git commit -m one --allow-empty
+                git checkout -b br/1
+                git commit -m two --allow-empty
+                git checkout -b br/2
+                git commit -m three --allow-empty
+                """,
+            )
+            output = get_stderr(repo, *PYTHON_STACK_ARGV, "inspect")
+            graph = get_stack_graph(repo)
+
+        shas = {node_id: node["sha"][:7] for node_id, node in graph.nodes.items()}
+        self.assertEqual(
+            output.splitlines(),
+            [
+                f"    ╙── main ┈ {shas['main']}",
+                f"        └─╼ br/1 ┈ {shas['br/1']}",
+                f"━━▶︎         └─╼ br/2 ┈ {shas['br/2']}",
+            ],
+        )
+
     def test_one_branch_forget_by_name(self):
         """One branch forgotten safely by name"""
-        with fresh_repo():
-            run_cmd(f"""
+        with fresh_repo() as repo:
+            run_cmd(
+                repo,
+                f"""
                 git commit -m one --allow-empty
                 git checkout -b br/1
                 git commit -m two --allow-empty
                 git checkout main
                 {PYTHON_STACK_PY} forget br/1
-                """)
-            log, graph = get_git_log(), get_stack_graph()
+                """,
+            )
+            log, graph = get_git_log(repo), get_stack_graph(repo)
 
         self.assertEqual(len(log), 1)
         self.assertEqual(log, ["one (HEAD -> main)"])